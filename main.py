@@ -1,20 +1,23 @@
 #!/usr/bin/env python3
 
+import functools
 import logging
 import os
+import pickle
 import platform
 import re
+import signal
+import struct
 import subprocess
+import sys
 import textwrap
+import threading
+import time
 import warnings
 from pathlib import Path
-from shutil import copy
-import yaml
+from shutil import copyfile, which
 
-import click
-import pyperclip
 from appdirs import user_config_dir
-from daemonize import Daemonize
 
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
@@ -59,24 +62,106 @@ def select(prompt, options, rofi_args=[], fuzzy=True):
     return code, index, selected
 
 
+def inkscapeWindowRunning():
+    """
+    Returns whether an interactive Inkscape is running. Headless instances,
+    like the watcher's `inkscape --shell`s, don't count.
+    """
+    running = subprocess.run(
+        ["pgrep", "-a", "-x", "inkscape"],
+        capture_output=True,
+        universal_newlines=True,
+    )
+
+    for line in running.stdout.splitlines():
+        arguments = line.split()[2:]
+        if not any(arg.startswith(("--shell", "--export")) for arg in arguments):
+            return True
+
+    return False
+
+
+def openInRunningInkscape(path):
+    """
+    Asks an already running Inkscape to open the file over D-Bus, which is a
+    lot faster than starting a new instance. Returns whether it worked.
+    """
+    if not which("gdbus") or not which("pgrep"):
+        return False
+
+    if not inkscapeWindowRunning():
+        return False
+
+    uri = Path(path).absolute().as_uri()
+    result = subprocess.run(
+        [
+            "gdbus",
+            "call",
+            "--session",
+            "--dest=org.inkscape.Inkscape",
+            "--object-path=/org/inkscape/Inkscape",
+            "--method=org.gtk.Application.Open",
+            "--timeout=3",
+            "['{}']".format(uri),
+            "",
+            "{}",
+        ],
+        capture_output=True,
+        timeout=5,
+    )
+    return result.returncode == 0
+
+
 def inkscape(path):
+    try:
+        if openInRunningInkscape(path):
+            return
+    except (OSError, subprocess.TimeoutExpired):
+        log.debug("Could not open %s in a running Inkscape", path)
+
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", ResourceWarning)
         subprocess.Popen(["inkscape", str(path)])
 
 
+@functools.lru_cache(maxsize=1)
+def clipboardCommand():
+    if os.environ.get("WAYLAND_DISPLAY") and which("wl-copy"):
+        return ["wl-copy"]
+    if which("xclip"):
+        return ["xclip", "-selection", "clipboard"]
+    if which("pbcopy"):
+        return ["pbcopy"]
+    return None
+
+
+def copyToClipboard(text):
+    command = clipboardCommand()
+    if command is None:
+        import pyperclip
+
+        pyperclip.copy(text)
+        return
+
+    subprocess.run(command, input=text, universal_newlines=True)
+
+
 def indent(text, indentation=0):
     lines = text.split("\n")
     return "\n".join(" " * indentation + line for line in lines)
 
 
+toSpaces = str.maketrans({"-": " ", "_": " "})
+toUnderscores = str.maketrans({"-": "_", " ": "_"})
+
+
 def beautify(name):
-    return name.replace("_", " ").replace("-", " ").title()
+    return name.translate(toSpaces).title()
 
 
 def latexTemplate(name, caption):
-    label = caption.replace("-", "_").replace(" ", "_").lower()
-    caption = caption.replace("-", " ").replace("_", " ").title()
+    label = caption.translate(toUnderscores).lower()
+    caption = caption.translate(toSpaces).title()
 
     return "\n".join(
         (
@@ -92,6 +177,21 @@ def latexTemplate(name, caption):
     )
 
 
+def snippetPath(figurePath):
+    return figurePath.with_suffix(".tex.snippet")
+
+
+def figureTemplate(figurePath):
+    """
+    Returns the LaTeX template of a figure, as saved when it was created.
+    """
+    try:
+        return snippetPath(figurePath).read_text()
+    except FileNotFoundError:
+        name = figurePath.stem
+        return latexTemplate(name, beautify(name))
+
+
 def importFile(name, path):
     import importlib.util as util
 
@@ -108,6 +208,32 @@ def importFile(name, path):
     return module
 
 
+def loadConfig(path):
+    # The parsed config is cached next to it, so yaml only has to be loaded
+    # when the config has changed
+    cache = path.with_suffix(".cache")
+    mtime = path.stat().st_mtime_ns
+
+    try:
+        cachedMtime, config = pickle.loads(cache.read_bytes())
+        if cachedMtime == mtime:
+            return config
+    except Exception:
+        # A missing or broken cache is just rebuilt
+        pass
+
+    import yaml
+
+    config = yaml.safe_load(path.read_text())
+
+    try:
+        cache.write_bytes(pickle.dumps((mtime, config)))
+    except OSError:
+        log.debug("Could not write config cache %s", cache)
+
+    return config
+
+
 userDir = Path(user_config_dir("lesson-manager"))
 
 if not userDir.is_dir():
@@ -116,7 +242,7 @@ if not userDir.is_dir():
 rootsFile = userDir / "roots"
 configFile = userDir / "config.yaml"
 template = userDir / "template.svg"
-configFile = yaml.safe_load(configFile.read_text())
+configFile = loadConfig(configFile)
 currentCourseDir = Path(configFile["current_course"])
 
 # Create the roots file if it does not exist
@@ -130,32 +256,39 @@ if currentCourseDir.is_file():
 # If the template file does not exist, copy the default template
 # to the current course directory
 if not template.is_file():
-    source = str(Path(__file__).parent / "template.svg")
-    destination = str(template)
-    copy(source, destination)
+    copyfile(Path(__file__).parent / "template.svg", template)
+
+
+# In-memory copy of the roots file, refreshed whenever its mtime changes. A
+# dict is used as an ordered set, so the file keeps its order when rewritten.
+rootsCache = None
+rootsMtime = None
 
 
 def addRoot(path):
+    global rootsMtime
+
     path = str(path)
-    roots = getRoots()
-    if path in roots:
+    getRoots()
+    if path in rootsCache:
         return None
 
-    roots.append(path)
-    rootsFile.write_text("\n".join(roots))
+    rootsCache[path] = None
+    rootsFile.write_text("\n".join(rootsCache))
+    rootsMtime = rootsFile.stat().st_mtime_ns
 
 
 def getRoots():
-    return [root for root in rootsFile.read_text().split("\n") if root != ""]
+    global rootsCache, rootsMtime
 
+    mtime = rootsFile.stat().st_mtime_ns
+    if rootsCache is None or mtime != rootsMtime:
+        rootsCache = dict.fromkeys(filter(None, rootsFile.read_text().splitlines()))
+        rootsMtime = mtime
 
-@click.group()
-def cli():
-    pass
+    return list(rootsCache)
 
 
-@cli.command()
-@click.option("--daemon/--no-daemon", default=True)
 def watch(daemon):
     """
     Watches for figures.
@@ -163,9 +296,11 @@ def watch(daemon):
     if platform.system() == "Linux":
         watcher_cmd = watchDaemonInotify
     else:
-        watcher_cmd = watchDaemonFSwatch
+        watcher_cmd = watchDaemonWatchdog
 
     if daemon:
+        from daemonize import Daemonize
+
         daemon = Daemonize(
             app="inkscape-figures",
             pid="/tmp/inkscape-figures.pid",
@@ -178,59 +313,64 @@ def watch(daemon):
         watcher_cmd()
 
 
-def maybeRecompileFigure(filepath):
-    filepath = Path(filepath)
-    if filepath.suffix != ".svg":
-        log.debug(
-            "File has changed, but is nog an svg {}".format(filepath.suffix),
-        )
-        return
+versionRegex = re.compile(r"(\d+)\.(\d+)(?:\.(\d+))?")
 
-    log.info("Recompiling %s", filepath)
 
-    pdfPath = filepath.parent / (filepath.stem + ".pdf")
-    name = filepath.stem
+@functools.lru_cache(maxsize=1)
+def inkscapeVersionTuple():
+    """
+    Returns the installed Inkscape version as a (major, minor, patch) tuple.
 
+    The version can't change while the watcher is running, so the probe is
+    only done once.
+    """
     inkscapeVersion = subprocess.check_output(
         ["inkscape", "--version"], universal_newlines=True
     )
     log.debug(inkscapeVersion)
 
-    inkscapeVersion = re.findall(r"[0-9.]+", inkscapeVersion)[0]
-    inkscapeVersionNumber = [
-        int(part)
-        for part in inkscapeVersion.split(
-            ".",
-        )
-    ]
+    match = versionRegex.search(inkscapeVersion)
+    return tuple(int(part or 0) for part in match.groups())
 
-    inkscapeVersionNumber = inkscapeVersionNumber + [0] * (
-        3 - len(inkscapeVersionNumber)
-    )
 
-    if inkscapeVersionNumber < [1, 0, 0]:
+@functools.lru_cache(maxsize=1)
+def exportCommandTemplate():
+    """
+    Returns the export command for the installed Inkscape version, together
+    with the indices of the svg and pdf path placeholders.
+    """
+    if inkscapeVersionTuple() < (1, 0, 0):
         command = [
             "inkscape",
             "--export-area-page",
             "--export-dpi",
             "300",
             "--export-pdf",
-            pdfPath,
-            "--export-latex",
-            filepath,
-        ]
-    else:
-        command = [
-            "inkscape",
-            filepath,
-            "--export-area-page",
-            "--export-dpi",
-            "300",
-            "--export-type=pdf",
+            None,
             "--export-latex",
-            "--export-filename",
-            pdfPath,
+            None,
         ]
+        return command, 7, 5
+
+    command = [
+        "inkscape",
+        None,
+        "--export-area-page",
+        "--export-dpi",
+        "300",
+        "--export-type=pdf",
+        "--export-latex",
+        "--export-filename",
+        None,
+    ]
+    return command, 1, 8
+
+
+def exportWithCommand(filepath, pdfPath):
+    command, pathIndex, pdfIndex = exportCommandTemplate()
+    command = command.copy()
+    command[pathIndex] = str(filepath)
+    command[pdfIndex] = str(pdfPath)
 
     log.debug("Running command:")
     log.debug(textwrap.indent(" ".join(str(e) for e in command), "  "))
@@ -242,83 +382,548 @@ def maybeRecompileFigure(filepath):
     else:
         log.debug("Command succeeded")
 
-    template = latexTemplate(name, beautify(name))
-    pyperclip.copy(template)
+
+# Long-running `inkscape --shell`s used to export figures (Inkscape >= 1.0),
+# so that we only pay Inkscape's startup time once. A shell handles one
+# command at a time, so export threads take one from this pool and put it
+# back when they're done. Shells that have been idle for a while are closed.
+idleInkscapeShells = []
+idleInkscapeShellsLock = threading.Lock()
+inkscapeShellIdleTimeout = 60
+inkscapeShellReaper = None
+inkscapeShellPrompt = "> "
+
+
+def readUntilPrompt(process):
+    """
+    Returns the output up to the next prompt, or None if the shell closed
+    its output first.
+    """
+    output = ""
+    while not output.endswith(inkscapeShellPrompt):
+        char = process.stdout.read(1)
+        if not char:
+            return None
+        output += char
+
+    return output[: -len(inkscapeShellPrompt)]
+
+
+def acquireInkscapeShell():
+    with idleInkscapeShellsLock:
+        # The most recently used shell comes first, so the others can idle
+        # out when there's only one export at a time
+        while idleInkscapeShells:
+            inkscapeShell, _ = idleInkscapeShells.pop()
+            if inkscapeShell.poll() is None:
+                return inkscapeShell
+
+            log.warning(
+                "Inkscape shell exited with code %s",
+                inkscapeShell.returncode,
+            )
+
+    log.debug("Starting Inkscape shell")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", ResourceWarning)
+        inkscapeShell = subprocess.Popen(
+            ["inkscape", "--shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+
+    # Skip the banner
+    readUntilPrompt(inkscapeShell)
+    return inkscapeShell
+
+
+def scheduleInkscapeShellReaper(delay):
+    # Called with idleInkscapeShellsLock held. A single timer is enough, as
+    # it reschedules itself for the next shell that goes idle.
+    global inkscapeShellReaper
+
+    if inkscapeShellReaper is not None:
+        return
+
+    inkscapeShellReaper = threading.Timer(delay, closeIdleInkscapeShells)
+    inkscapeShellReaper.daemon = True
+    inkscapeShellReaper.start()
+
+
+def releaseInkscapeShell(inkscapeShell):
+    with idleInkscapeShellsLock:
+        idleInkscapeShells.append((inkscapeShell, time.monotonic()))
+        scheduleInkscapeShellReaper(inkscapeShellIdleTimeout)
+
+
+def closeIdleInkscapeShells():
+    global inkscapeShellReaper
+
+    with idleInkscapeShellsLock:
+        inkscapeShellReaper = None
+
+        now = time.monotonic()
+        idle = [
+            shell
+            for shell, since in idleInkscapeShells
+            if now - since >= inkscapeShellIdleTimeout
+        ]
+        idleInkscapeShells[:] = [
+            (shell, since)
+            for shell, since in idleInkscapeShells
+            if shell not in idle
+        ]
+
+        if idleInkscapeShells:
+            oldest = min(since for _, since in idleInkscapeShells)
+            scheduleInkscapeShellReaper(oldest + inkscapeShellIdleTimeout - now)
+
+    for inkscapeShell in idle:
+        log.debug("Closing idle Inkscape shell")
+        try:
+            inkscapeShell.stdin.close()
+            inkscapeShell.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            inkscapeShell.kill()
+
+
+def pdfModificationTime(pdfPath):
+    try:
+        return os.stat(pdfPath).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def exportWithShell(filepath, pdfPath):
+    # Actions are separated by `;` and commands by newlines, so such paths
+    # can't be passed to the shell
+    if any(char in str(path) for path in (filepath, pdfPath) for char in ";\n"):
+        exportWithCommand(filepath, pdfPath)
+        return
+
+    command = (
+        f"file-open:{filepath}; export-filename:{pdfPath}; export-dpi:300; "
+        "export-area-page; export-latex; export-do; file-close\n"
+    )
+
+    log.debug("Running shell command:")
+    log.debug(textwrap.indent(command, "  "))
+
+    # The shell keeps running when an export fails, so check that the pdf
+    # was written instead. File timestamps are coarser than the clock, so
+    # compare against the pdf's previous mtime rather than the current time.
+    previousMtime = pdfModificationTime(pdfPath)
+
+    # Retry once if the shell died in the meantime
+    for _ in range(2):
+        shell = acquireInkscapeShell()
+        try:
+            shell.stdin.write(command)
+            shell.stdin.flush()
+        except BrokenPipeError:
+            shell.kill()
+            log.warning("Inkscape shell exited with code %s", shell.wait())
+            continue
+
+        output = readUntilPrompt(shell)
+        if output is None:
+            # The shell died, even if it hasn't been reaped yet
+            shell.kill()
+            log.warning("Inkscape shell exited with code %s", shell.wait())
+            continue
+
+        releaseInkscapeShell(shell)
+
+        if output.strip():
+            log.debug(textwrap.indent(output, "  "))
+
+        mtime = pdfModificationTime(pdfPath)
+        if mtime is None or mtime == previousMtime:
+            log.error("Inkscape shell did not write %s", pdfPath)
+        else:
+            log.debug("Command succeeded")
+        return
+
+    log.error("Inkscape shell failed to export %s", filepath)
+
+
+# Modification time of each figure when it was last exported
+exportedMtimes = {}
+
+
+def maybeRecompileFigure(filepath):
+    # Plain strings are enough here, and cheaper than Path objects
+    filepath = str(filepath)
+    if not filepath.endswith(".svg"):
+        log.debug(
+            "File has changed, but is nog an svg {}".format(Path(filepath).suffix),
+        )
+        return
+
+    pdfPath = filepath[: -len(".svg")] + ".pdf"
+
+    try:
+        svgMtime = os.stat(filepath).st_mtime_ns
+    except FileNotFoundError:
+        log.debug("%s no longer exists", filepath)
+        return
+
+    try:
+        pdfMtime = os.stat(pdfPath).st_mtime_ns
+    except FileNotFoundError:
+        pdfMtime = 0
+
+    # A save made during an export is older than the pdf it produced, so
+    # also check which version of the figure was exported last
+    exported = exportedMtimes.get(filepath, svgMtime)
+    if svgMtime <= pdfMtime and exported >= svgMtime:
+        log.info("%s is up to date", filepath)
+    else:
+        log.info("Recompiling %s", filepath)
+        exportedMtimes[filepath] = svgMtime
+
+        if inkscapeVersionTuple() >= (1, 0, 0):
+            exportWithShell(filepath, pdfPath)
+        else:
+            exportWithCommand(filepath, pdfPath)
+
+    # When several figures are exported at once, only copy the template of
+    # the one the user edited last
+    if filepath != lastChangedFigure:
+        return
+
+    template = figureTemplate(Path(filepath))
+    copyToClipboard(template)
     log.debug("Copying LaTeX template:")
     log.debug(textwrap.indent(template, "    "))
 
 
+def numberFromEnvironment(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+
+    try:
+        return float(value)
+    except ValueError:
+        log.warning("Invalid %s=%r, using %s", name, value, default)
+        return default
+
+
+@functools.lru_cache(maxsize=1)
+def debounceDelay():
+    # Editors often report a single save as several events, so a file is
+    # only recompiled once it hasn't changed for this long
+    return numberFromEnvironment("INKFIG_DEBOUNCE_MS", 100) / 1000
+
+
+pendingRecompiles = {}
+pendingRecompilesLock = threading.Lock()
+lastChangedFigure = None
+
+runningRecompiles = set()
+rerunRecompiles = set()
+
+
+@functools.lru_cache(maxsize=1)
+def recompileExecutor():
+    # Exports are CPU bound and independent, so they're spread over all
+    # cores. Threads are enough since they just wait for Inkscape.
+    from concurrent.futures import ThreadPoolExecutor
+
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def queueRecompile(filepath):
+    global lastChangedFigure
+
+    with pendingRecompilesLock:
+        pendingRecompiles[str(filepath)] = time.monotonic()
+        lastChangedFigure = str(filepath)
+
+
+def runRecompile(path):
+    while True:
+        try:
+            maybeRecompileFigure(path)
+        except Exception:
+            log.exception("Could not recompile %s", path)
+
+        with pendingRecompilesLock:
+            if path not in rerunRecompiles:
+                runningRecompiles.discard(path)
+                return
+            rerunRecompiles.discard(path)
+
+
+def recompileInBackground(path):
+    with pendingRecompilesLock:
+        # Don't export the same file twice at once; export it again
+        # once the running export is done instead
+        if path in runningRecompiles:
+            rerunRecompiles.add(path)
+            return
+        runningRecompiles.add(path)
+
+    recompileExecutor().submit(runRecompile, path)
+
+
+def flushRecompiles():
+    """
+    Recompiles the queued files that have settled, and returns the number of
+    seconds until the next one settles (None if nothing is queued).
+    """
+    with pendingRecompilesLock:
+        now = time.monotonic()
+        settled = [
+            path
+            for path, changed in pendingRecompiles.items()
+            if now - changed >= debounceDelay()
+        ]
+        for path in settled:
+            del pendingRecompiles[path]
+
+    for path in settled:
+        recompileInBackground(path)
+
+    with pendingRecompilesLock:
+        if not pendingRecompiles:
+            return None
+        nextChange = min(pendingRecompiles.values())
+
+    return max(0, nextChange + debounceDelay() - time.monotonic())
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+inotifyEvent = struct.Struct("iIII")
+
+
+class Inotify:
+    """
+    Minimal non-blocking inotify binding exposing the raw file descriptor,
+    so it can be waited on by an event loop and drained in batches.
+    """
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self.raiseErrno("inotify_init1")
+
+    def raiseErrno(self, call, path=None):
+        import ctypes
+
+        errno = ctypes.get_errno()
+        raise OSError(errno, "{}: {}".format(call, os.strerror(errno)), path)
+
+    def addWatch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self.raiseErrno("inotify_add_watch", path)
+        return wd
+
+    def removeWatch(self, wd):
+        if self.libc.inotify_rm_watch(self.fd, wd) < 0:
+            self.raiseErrno("inotify_rm_watch")
+
+    def readEvents(self):
+        """
+        Reads all pending events until the descriptor would block.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = inotifyEvent.unpack_from(data, offset)
+                offset += inotifyEvent.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+
 def watchDaemonInotify():
-    import inotify.adapters
-    from inotify.constants import IN_CLOSE_WRITE
+    import asyncio
+
+    asyncio.run(watchInotify())
+
+
+async def watchInotify():
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    inotify = Inotify()
+
+    reloadWatches = asyncio.Event()
+
+    def reloadRequested():
+        log.info("Reload requested. Updating watches.")
+        reloadWatches.set()
+
+    loop.add_signal_handler(signal.SIGHUP, reloadRequested)
+
+    flushHandle = None
+
+    def scheduleFlush():
+        nonlocal flushHandle
+
+        if flushHandle is not None:
+            flushHandle.cancel()
+
+        # Exports run in the background, so this never stalls the loop
+        timeout = flushRecompiles()
+        if timeout is None:
+            flushHandle = None
+        else:
+            flushHandle = loop.call_later(timeout, scheduleFlush)
 
     while True:
         roots = getRoots()
 
-        i = inotify.adapters.Inotify()
-        i.add_watch(str(rootsFile), mask=IN_CLOSE_WRITE)
+        rootsWatch = inotify.addWatch(rootsFile, IN_CLOSE_WRITE)
 
-        log.info("Watching directories: " + ", ".join(getRoots()))
+        # Only the figures themselves are watched for writes, so the pdf
+        # files we export (and any other files) don't generate events. The
+        # directories are only watched for new figures.
+        directoryWatches = {}
+        figureWatches = {}
+
+        def watchFigure(path):
+            try:
+                figureWatches[inotify.addWatch(path, IN_CLOSE_WRITE)] = path
+            except OSError:
+                log.debug("Could not watch figure %s", path)
+
+        log.info("Watching directories: " + ", ".join(roots))
         for root in roots:
             try:
-                i.add_watch(root, mask=IN_CLOSE_WRITE)
-            except Exception:
+                wd = inotify.addWatch(root, IN_CREATE | IN_MOVED_TO)
+            except OSError:
                 log.debug("Could not add root %s", root)
+                continue
+
+            directoryWatches[wd] = root
+            for path in Path(root).glob("*.svg"):
+                watchFigure(str(path))
+
+        def drainEvents():
+            for wd, mask, filename in inotify.readEvents():
+                if wd == rootsWatch:
+                    if mask & IN_CLOSE_WRITE:
+                        log.info("The roots file has been updated. Updating watches.")
+                        reloadWatches.set()
+                elif wd in figureWatches:
+                    if mask & IN_IGNORED:
+                        # The figure was deleted or replaced
+                        del figureWatches[wd]
+                    else:
+                        # A figure has changed
+                        queueRecompile(figureWatches[wd])
+                elif wd in directoryWatches and filename.endswith(".svg"):
+                    # A figure was created, or saved by moving a new file
+                    # over it
+                    path = os.path.join(directoryWatches[wd], filename)
+                    watchFigure(path)
+                    queueRecompile(path)
+
+            scheduleFlush()
+
+        # The reader is level-triggered, so events that arrive while the
+        # watches are being replaced are picked up afterwards
+        loop.add_reader(inotify.fd, drainEvents)
+        await reloadWatches.wait()
+        reloadWatches.clear()
+        loop.remove_reader(inotify.fd)
+
+        watches = [
+            (rootsWatch, rootsFile),
+            *directoryWatches.items(),
+            *figureWatches.items(),
+        ]
+        for wd, path in watches:
+            try:
+                inotify.removeWatch(wd)
+                log.debug("Removed watch %s", path)
+            except OSError:
+                log.debug("Could not remove watch %s", path)
 
-        for event in i.event_gen(yield_nones=False):
-            if event is None:
-                return
 
-            (_, _, path, filename) = event
+def watchDaemonWatchdog():
+    from watchdog.events import PatternMatchingEventHandler
+    from watchdog.observers import Observer
 
-            if path == str(rootsFile):
-                log.info("The roots file has been updated. Updating watches.")
-                for root in roots:
-                    try:
-                        i.remove_watch(root)
-                        log.debug("Removed root %s", root)
-                    except Exception:
-                        log.debug("Could not remove root %s", root)
-                break
+    latency = numberFromEnvironment("INKFIG_FSEVENTS_LATENCY", None)
+    if latency is not None and platform.system() == "Darwin":
+        from watchdog.observers.fsevents import FSEventsObserver
 
-            # A file has changed
-            path = Path(path) / filename
-            maybeRecompileFigure(path)
+        observer = FSEventsObserver(timeout=latency)
+    else:
+        observer = Observer()
+
+    class FigureHandler(PatternMatchingEventHandler):
+        def __init__(self):
+            super().__init__(patterns=["*.svg"], ignore_directories=True)
+
+        def recompile(self, path):
+            queueRecompile(path)
+            threading.Timer(debounceDelay(), flushRecompiles).start()
+
+        def on_created(self, event):
+            self.recompile(event.src_path)
 
+        def on_modified(self, event):
+            self.recompile(event.src_path)
+
+        def on_moved(self, event):
+            if event.dest_path.endswith(".svg"):
+                self.recompile(event.dest_path)
+
+    rootsChanged = threading.Event()
+
+    class RootsHandler(PatternMatchingEventHandler):
+        def __init__(self):
+            super().__init__(patterns=[str(rootsFile)], ignore_directories=True)
+
+        def on_any_event(self, event):
+            rootsChanged.set()
+
+    figureHandler = FigureHandler()
+    rootsHandler = RootsHandler()
+    observer.start()
 
-def watchDaemonFSwatch():
     while True:
         roots = getRoots()
         log.info("Watching directories: " + ", ".join(roots))
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", ResourceWarning)
-            p = subprocess.Popen(
-                ["fswatch", *roots, str(userDir)],
-                stdout=subprocess.PIPE,
-                universal_newlines=True,
-            )
 
-        while True:
-            if not p.stdout:
-                return
+        observer.schedule(rootsHandler, str(userDir))
+        for root in roots:
+            try:
+                observer.schedule(figureHandler, root)
+            except OSError:
+                log.debug("Could not add root %s", root)
 
-            filepath = p.stdout.readline().strip()
+        rootsChanged.wait()
+        rootsChanged.clear()
 
-            if filepath == str(rootsFile):
-                log.info("The roots file has been updated. Updating watches.")
-                p.terminate()
-                log.debug("Removed main watch %s")
-                break
-            maybeRecompileFigure(filepath)
+        log.info("The roots file has been updated. Updating watches.")
+        observer.unschedule_all()
 
 
-@cli.command()
-@click.argument("title")
-@click.argument(
-    "root",
-    default=os.getcwd(),
-    type=click.Path(exists=False, file_okay=False, dir_okay=True),
-)
 def create(title, root):
     title = title.strip()
     fileName = title.replace(" ", "-").lower() + ".svg"
@@ -332,43 +937,121 @@ def create(title, root):
         print(title + " 2")
         return
 
-    copy(str(template), str(figurePath))
+    copyfile(template, figurePath)
+
+    # Save the snippet before anything slow, as the watcher picks up the new
+    # figure right away and copies its snippet
+    latex = latexTemplate(figurePath.stem, title)
+    snippetPath(figurePath).write_text(latex)
+
     addRoot(figures)
     inkscape(figurePath)
 
     leadingSpaces = len(title) - len(title.lstrip())
-    print(
-        indent(
-            latexTemplate(figurePath.stem, title),
-            indentation=leadingSpaces,
-        )
-    )
+    print(indent(latex, indentation=leadingSpaces))
 
 
-@cli.command()
-@click.argument(
-    "root",
-    default=os.getcwd(),
-    type=click.Path(exists=True, file_okay=False, dir_okay=True),
-)
 def edit(root):
     figures = Path(root).absolute()
 
-    files = figures.glob("*.svg")
-    files = sorted(files, key=lambda f: f.stat().st_mtime, reverse=True)
+    # DirEntry caches its stat result, unlike Path
+    with os.scandir(figures) as it:
+        entries = [e for e in it if e.is_file() and e.name.endswith(".svg")]
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
 
-    names = [beautify(f.stem) for f in files]
+    files = [Path(e.path) for e in entries]
+    names = [beautify(e.name[: -len(".svg")]) for e in entries]
     _, index, selected = select("Select figure", names)
     if selected:
         path = files[index]
         addRoot(figures)
         inkscape(path)
 
-        template = latexTemplate(path.stem, beautify(path.stem))
-        pyperclip.copy(template)
+        template = figureTemplate(path)
+        copyToClipboard(template)
         log.debug("Copying LaTeX template:")
         log.debug(textwrap.indent(template, "    "))
 
 
+def cli(args=None):
+    """
+    Click interface to all commands.
+    """
+    import click
+
+    @click.group()
+    def group():
+        pass
+
+    @group.command(name="watch")
+    @click.option("--daemon/--no-daemon", default=True)
+    def watchCommand(daemon):
+        """
+        Watches for figures.
+        """
+        watch(daemon)
+
+    @group.command(name="create")
+    @click.argument("title")
+    @click.argument(
+        "root",
+        default=os.getcwd(),
+        type=click.Path(exists=False, file_okay=False, dir_okay=True),
+    )
+    def createCommand(title, root):
+        create(title, root)
+
+    @group.command(name="edit")
+    @click.argument(
+        "root",
+        default=os.getcwd(),
+        type=click.Path(exists=True, file_okay=False, dir_okay=True),
+    )
+    def editCommand(root):
+        edit(root)
+
+    group(args=args)
+
+
+# `create` and `edit` are run from editor mappings, so they skip click and
+# parse their few arguments with argparse instead.
+def createMain(args):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="inkscape-figures create")
+    parser.add_argument("title")
+    parser.add_argument("root", nargs="?", default=os.getcwd())
+    args = parser.parse_args(args)
+
+    if Path(args.root).is_file():
+        parser.error("root '{}' is a file".format(args.root))
+
+    create(args.title, args.root)
+
+
+def editMain(args):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="inkscape-figures edit")
+    parser.add_argument("root", nargs="?", default=os.getcwd())
+    args = parser.parse_args(args)
+
+    if not Path(args.root).is_dir():
+        parser.error("root '{}' is not a directory".format(args.root))
+
+    edit(args.root)
+
+
+def main(args):
+    command = args[0] if args else "--help"
+
+    if command == "create":
+        createMain(args[1:])
+    elif command == "edit":
+        editMain(args[1:])
+    else:
+        cli(args)
+
+
 if __name__ == "__main__":
-    cli()
+    main(sys.argv[1:])